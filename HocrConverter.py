@@ -30,12 +30,20 @@ from reportlab.lib.units import inch
 from reportlab.lib.units import pica
 from reportlab.pdfbase import pdfmetrics
 from reportlab.pdfbase.ttfonts import TTFont
-from xml.etree.ElementTree import ElementTree
 import PIL.Image
+import mmap
+import functools
+import itertools
 import re
 import sys
 import logging
 import unicodedata
+try:
+  import lxml.etree as ET
+except ImportError:
+  exit('This script requires that python `lxml` XML parsing library'
+       ' is installed: \n pip install lxml\n'
+       'https://lxml.de')
 try:
   from docopt import docopt
 except ImportError:
@@ -49,6 +57,21 @@ except ImportError:
        ' is installed: \n pip install schema\n'
        'https://github.com/halst/schema')
 
+# Patterns for parsing hOCR, compiled once for all instances
+_BOX_RE = re.compile(r'bbox((\s+\d+){4})')
+_FILE_RE = re.compile(r"(?:file|image)\s+(\"[^\"]+\"|'[^']+'|[^\s'\"]+)")
+_NS_RE = re.compile(r'({.*})html')
+
+# hOCR classes that are put on the pdf page
+_TEXT_CLASSES = frozenset([ 'ocr_line', 'ocrx_word', 'ocr_carea', 'ocr_par' ])
+
+@functools.lru_cache(maxsize=4096)
+def _strwidth(text, fontname, fontsize, _face=pdfmetrics.getFont):
+  """
+  Width of text in points, cached as hOCR repeats many short tokens
+  """
+  return _face(fontname).stringWidth(text, fontsize)
+
 class HocrConverter():
   """
   A class for converting documents to/from the hOCR format.
@@ -74,10 +97,9 @@ class HocrConverter():
 
   def __init__(self, hocrFileName = None):
     self.hocr = None
+    self.hocrFileName = None
     self.xmlns = ''
-    self.boxPattern = re.compile('bbox((\s+\d+){4})')
-    # self.filenamePattern = re.compile('file\s+(.*)')  
-    self.filenamePattern = re.compile(".*(file|image)\s((?:\"|')(?:[^'\"]+)(?:['\"])|(?:[^\s'\"]+)).*")
+    self._image = None
     if hocrFileName is not None:
       self.parse_hocr(hocrFileName)
       
@@ -85,10 +107,12 @@ class HocrConverter():
     """
     Return the textual content of the HTML body
     """
-    if self.hocr is None:
+    if self.hocrFileName is None:
       return ''
+    if self.hocr is None:
+      self.hocr = ET.parse(self.hocrFileName)
     body =  self.hocr.find(".//%sbody"%(self.xmlns))
-    if body:
+    if body is not None:
       return self._get_element_text(body).encode('utf-8') # XML gives unicode
     else:
       return ''
@@ -97,29 +121,23 @@ class HocrConverter():
     """
     Return the textual content of the element and its children
     """
-    text = ''
-    if element.text is not None:
-      text = text + element.text
-    for child in element.getchildren():
-      text = text + self._get_element_text(child)
-    if element.tail is not None:
-      text = text + element.tail
-    return text
+    return "".join(element.itertext())
   
   def parse_element_title(self, element):
+    dict_return = {}
     if 'title' in element.attrib:
-      dict_return = {}
       
-      vprint( VVERBOSE, element.attrib['title'] )
-      matches = self.boxPattern.search(element.attrib['title'])
+      if logging.root.isEnabledFor( VVERBOSE ):
+        logging.log( VVERBOSE, "%s", element.attrib['title'] )
+      matches = _BOX_RE.search(element.attrib['title'])
       if matches:
         coords = matches.group(1).split()
         out = (int(coords[0]),int(coords[1]),int(coords[2]),int(coords[3]))
         dict_return[ "bbox" ] = out
    
-      matches = self.filenamePattern.search(element.attrib['title'])
+      matches = _FILE_RE.search(element.attrib['title'])
       if matches:        
-        dict_return[ "file" ] = matches.groups()[1].strip("\"'")
+        dict_return[ "file" ] = matches.group(1).strip("\"'")
     
     return dict_return
     
@@ -137,23 +155,63 @@ class HocrConverter():
     
   def parse_hocr(self, hocrFileName):
     """
-    Reads an XML/XHTML file into an ElementTree object
+    Registers an XML/XHTML file for streaming and detects its namespace.
+    The document itself is only read page by page, see pages_iter
     """
-    self.hocr = ElementTree()
-    self.hocr.parse(hocrFileName)
-    
+    self.hocr = None
+    self.hocrFileName = hocrFileName
+
+    # only the root tag is needed, so stop at the first start event
+    root_tag = ''
+    with open(hocrFileName, 'rb') as hocrFile:
+      for event, elem in ET.iterparse(hocrFile, events=('start',)):
+        root_tag = elem.tag
+        break
+
     # if the hOCR file has a namespace, ElementTree requires its use to find elements
-    matches = re.match('({.*})html', self.hocr.getroot().tag)
+    matches = _NS_RE.match(root_tag)
     if matches:
       self.xmlns = matches.group(1)
     else:
       self.xmlns = ''
 
+  def pages_iter(self, hocrFileName):
+    """
+    Yields the ocr_page elements of an hOCR file one after another.
+    Each page is cleared once the consumer moves on, so only the page
+    currently being processed is held in memory
+    """
+    for event, elem in ET.iterparse(hocrFileName, events=('end',), tag="%sdiv"%(self.xmlns)):
+      if elem.attrib.get('class') == 'ocr_page':
+        yield elem
+        elem.clear()
+        while elem.getprevious() is not None:
+          del elem.getparent()[0]
+
+  def _image_meta(self, imageFileName):
+    """
+    Returns size and dpi of an image without decoding its pixel data
+    """
+    with PIL.Image.open(imageFileName) as im:
+      return im.size, im.info.get('dpi')
+
   def _setup_image(self, imageFileName):
-    
+    """
+    Opens an image for embedding. The file is memory-mapped and the
+    most recent image is kept, so consecutive pages sharing an image only
+    parse it once
+    """
+    if self._image is not None and self._image[0] == imageFileName:
+      return self._image[1:4]
+
+    # earlier pages are already written, don't keep their pixels around
+    self._release_image()
+
     vprint( INFO, "Image File:", imageFileName )
-      
-    im = PIL.Image.open(imageFileName)
+
+    with open(imageFileName, 'rb') as imageFile:
+      mm = mmap.mmap(imageFile.fileno(), 0, access=mmap.ACCESS_READ)
+    im = PIL.Image.open(mm)
     imwidthpx, imheightpx = im.size
     
     vprint( VERBOSE, "Image Dimensions:", im.size )
@@ -166,47 +224,56 @@ class HocrConverter():
       # set to None for now and try again using info from hOCR file
       width = height = None
     
+    self._image = (imageFileName, im, width, height, mm)
     return (im, width, height)
 
+  def _release_image(self):
+    """
+    Drops the kept image and unmaps its file
+    """
+    if self._image is not None:
+      imageFileName, im, width, height, mm = self._image
+      im.close()
+      mm.close()
+      self._image = None
+
   def get_ocr_text_extension( self, page ):
     """
     Get the maximum extension of the area covered by text
     """
-    if not self.hocr:
+    if self.hocrFileName is None:
       vprint( VERBOSE, "No hOCR." )
       return None
 
-    x_min = x_max = y_min = y_max = 0
+    # one bbox (x0, y0, x1, y1) per ocr_line
+    boxes = [ self.parse_element_title(line).get("bbox", (0,0,0,0))
+              for line in page.iterfind(".//%sspan"%(self.xmlns))
+              if line.attrib.get('class') == 'ocr_line' ]
 
-    for line in page.findall(".//%sspan"%(self.xmlns)):
-      if line.attrib['class'] == 'ocr_line':
-        text_coords = self.element_coordinates(line)
-      
-        for coord_x in [ text_coords[0], text_coords[2] ]:
-          if coord_x > x_max:
-            x_max = coord_x
-          if coord_x < x_min:
-            x_min = coord_x
-        for coord_y in [ text_coords[1], text_coords[3] ]:
-          if coord_y > y_max:
-            y_max = coord_y
-          if coord_y < y_min:
-            y_min = coord_y
-
-    return (x_min,y_min,x_max,y_max)
+    if not boxes:
+      return (0,0,0,0)
+
+    return ( min( box[0] for box in boxes ), min( box[1] for box in boxes ),
+             max( box[2] for box in boxes ), max( box[3] for box in boxes ) )
 
   def getTextElements( self, parent_element ):
-    text_element_types = [ "p", "span" ]
-    
-    text_elements = []
-    for cat in text_element_types:
-      cat_text_elements = parent_element.findall(".//%s%s"%(self.xmlns,cat))
-      vprint( VVERBOSE, cat,":",len(cat_text_elements) )
-      text_elements.extend( cat_text_elements )
+    """
+    Returns all p and span elements below parent_element carrying one of
+    the text classes, collected in a single walk of the subtree
+    """
+    return [ e for e in parent_element.iter("%sp"%(self.xmlns), "%sspan"%(self.xmlns)) if e.get('class') in _TEXT_CLASSES ]
 
-    return text_elements
+  def to_pdf(self, *args, **keywords):
+    """
+    Creates a PDF file, see _write_pdf. The image kept for the last page
+    is released afterwards, also if writing fails
+    """
+    try:
+      self._write_pdf(*args, **keywords)
+    finally:
+      self._release_image()
 
-  def to_pdf(self, imageFileNames, outFileName, fontname="Helvetica", fontsize=12, withVisibleOCRText=False, withVisibleImage=True, withVisibleBoundingBoxes=False, noPictureFromHocr=False, multiplePages=False, hocrImageReference=False, verticalInversion=False ):
+  def _write_pdf(self, imageFileNames, outFileName, fontname="Helvetica", fontsize=12, withVisibleOCRText=False, withVisibleImage=True, withVisibleBoundingBoxes=False, noPictureFromHocr=False, multiplePages=False, hocrImageReference=False, verticalInversion=False ):
     """
     Creates a PDF file with an image superimposed on top of the text.
     
@@ -220,62 +287,44 @@ class HocrConverter():
     # create the PDF file 
     pdf = Canvas(outFileName, pageCompression=1)
 
-    if self.hocr is None:
+    if self.hocrFileName is None:
       # warn that no text will be embedded in the output PDF
       vprint( WARN, "Warning: No hOCR file specified. PDF will be image-only." )
 
     if inputFontFileName is not None:
       pdfmetrics.registerFont(TTFont('Custom', inputFontFileName))
       fontname = "Custom"
+      # widths measured with a previously registered custom font are stale
+      _strwidth.cache_clear()
     
-    # Collect pages from hOCR
-    pages = []
-    if self.hocr is not None:
-      divs = self.hocr.findall(".//%sdiv"%(self.xmlns))
-      for div in divs:
-        if div.attrib['class'] == 'ocr_page':
-          pages.append(div)
-
-    vprint( VVERBOSE, len(pages), "pages;", len(imageFileNames), "image files from command line." ) 
+    # Stream pages from hOCR
+    if self.hocrFileName is not None:
+      pages = self.pages_iter(self.hocrFileName)
+    else:
+      pages = iter(())
+
+    vprint( VVERBOSE, len(imageFileNames), "image files from command line." ) 
     
-    page_count = 0
-    # loop pages
-    while True:
-      page_count += 1
+    page_images = imageFileNames
+    if not multiplePages:
+      vprint (INFO, "Only processing one page." )
+      # there shouldn't be more than one, and if there is, we don't want it
+      pages = itertools.islice(pages, 1)
+      page_images = imageFileNames[:1]
+
+    # loop pages, pairing each hOCR page with an image from the command line
+    for page_count, (page, imageFileName) in enumerate(itertools.zip_longest(pages, page_images, fillvalue=None), start=1):
       vprint( VERBOSE, "page", page_count )
-      
-      if len(pages) >= page_count:
-        page = pages[page_count-1] 
-      else:
-        page = None
 
-      if page_count > 1:
-        if not multiplePages:
-          vprint (INFO, "Only processing one page." )
-          break # there shouldn't be more than one, and if there is, we don't want it
-     
-      imageFileName = None
-      
-      # Check for image from command line 
-      if imageFileNames:
-        # distinct file
-        if len(imageFileNames) >= page_count:
-          imageFileName = imageFileNames[page_count-1]
-        # repeat the last file
-        else:
-          imageFileName = imageFileNames[-1]
-          # stop if no more ocr date
-          if page == None:
-            break
-      else:
-        if page == None:
-          break
+      # repeat the last file for the remaining ocr pages
+      if imageFileName is None and imageFileNames:
+        imageFileName = imageFileNames[-1]
 
       vprint ( VERBOSE, "Image file name:", imageFileName )
       
-      vprint ( VERBOSE, "page:", page.tag, page.attrib )
       # Dimensions of ocr-page
       if page is not None:
+        vprint ( VERBOSE, "page:", page.tag, page.attrib )
         coords = self.element_coordinates( page )
       else:
         coords = (0,0,0,0)
@@ -292,7 +341,7 @@ class HocrConverter():
         
       # Image from hOCR
       # get dimensions, which may not match the image
-      im_ocr = None
+      im_ocr_size = None
       if page is not None:
         parse_result = self.parse_element_title( page )
         vprint( VVERBOSE, "ocr_page file ?" )
@@ -308,13 +357,15 @@ class HocrConverter():
 
           vprint( VERBOSE, "" )
 
-          if ( ( not noPictureFromHocr ) and ( not imageFileName) ) or hocrImageReference:
-            im_ocr, width_ocr, height_ocr = self._setup_image(imageFileName_ocr_page)
-            vprint( VERBOSE, "hOCR width, heigth:", width, height )
           if ( not noPictureFromHocr ) and ( not imageFileName):
-            im = im_ocr
-            width = width_ocr
-            height = height_ocr
+            # the hOCR image goes into the pdf
+            im, width, height = self._setup_image(imageFileName_ocr_page)
+            im_ocr_size = im.size
+            vprint( VERBOSE, "hOCR width, heigth:", width, height )
+          elif hocrImageReference:
+            # only the size is needed as reference
+            im_ocr_size, _ = self._image_meta(imageFileName_ocr_page)
+            vprint( VERBOSE, "hOCR image size:", im_ocr_size )
 
         # Get size of text area in hOCR-file
         ocr_text_x_min, ocr_text_y_min, ocr_text_x_max, ocr_text_y_max = self.get_ocr_text_extension( page )
@@ -322,14 +373,14 @@ class HocrConverter():
         ocr_text_height = ocr_text_y_max
 
         if not ocrwidth:
-          if im_ocr:
-            ocrwidth = im_ocr.size[0]
+          if im_ocr_size:
+            ocrwidth = im_ocr_size[0]
           else:
             ocrwidth = ocr_text_width 
 
         if not ocrheight:
-          if im_ocr:
-            ocrheight = im_ocr.size[1]
+          if im_ocr_size:
+            ocrheight = im_ocr_size[1]
           else:
             ocrheight = ocr_text_height
      
@@ -373,17 +424,33 @@ class HocrConverter():
             vprint( INFO, "No inline image file supplied." )
        
         # put ocr-content on the page 
-        if self.hocr is not None:
+        if page is not None:
           text_elements = self.getTextElements( page )
+
+          # constant for the whole page: hOCR pixels -> pdf points
+          sx = inch/ocr_dpi[0]
+          sy = inch/ocr_dpi[1]
+          page_h_pts = height*inch
+
+          # one text object for all elements of the page
+          text = pdf.beginText()
+          text.setFont(fontname, fontsize)
+          if not withVisibleOCRText:
+            text.setTextRenderMode(3) # invisible
+
+          last_fill = None
+
+          # bounding boxes, one path per box color
+          bbox_paths = {}
           
           for line in text_elements:
-            import pdb
-            vprint( VVERBOSE, line.tag, line.attrib )
+            if logging.root.isEnabledFor( VVERBOSE ):
+              logging.log( VVERBOSE, "%s %s", line.tag, line.attrib )
             if 'class' in line.attrib:
               text_class = line.attrib['class']
             else:
               text_class = None
-            if text_class in [ 'ocr_line', 'ocrx_word', 'ocr_carea', 'ocr_par' ]:
+            if text_class in _TEXT_CLASSES:
               
               if text_class == 'ocr_line':
                 textColor = (0,0,0)
@@ -397,35 +464,17 @@ class HocrConverter():
               elif text_class == 'ocr_par' :
                 textColor = (255,0,0)
                 bboxColor = (255,0,0)
-              
-              coords = self.element_coordinates( line )
-              parse_result = self.parse_element_title( line )
-              
-              text = pdf.beginText()
-              text.setFont(fontname, fontsize)
-              
-              text_corner1x = (float(coords[0])/ocr_dpi[0])*inch
-              text_corner1y = (float(coords[1])/ocr_dpi[1])*inch
 
-              text_corner2x = (float(coords[2])/ocr_dpi[0])*inch
-              text_corner2y = (float(coords[3])/ocr_dpi[1])*inch
-              
-              text_width = text_corner2x - text_corner1x
-              text_height = text_corner2y - text_corner1y
-              
-              if verticalInversion:
-                text_corner2y_inv = (height*inch) - text_corner1y
-                text_corner1y_inv = (height*inch) - text_corner2y
-                
-                text_corner1y = text_corner1y_inv
-                text_corner2y = text_corner2y_inv
+              # text areas and paragraphs only contribute their box
+              if text_class in ( 'ocr_carea', 'ocr_par' ) and not withVisibleBoundingBoxes:
+                continue
 
-              # set cursor to bottom left corner of line bbox (adjust for dpi)
-              text.setTextOrigin( text_corner1x, text_corner1y )
-           
               # The content of the text to write
               if withFullLineText:
-                textContent = unicodedata.normalize("NFC",unicode(" ".join([elem for elem in map((lambda text: text.strip()),line.itertext()) if len(elem) > 0])))
+                textContent = " ".join(t.strip() for t in line.itertext() if t.strip())
+                # NFC does not change pure ASCII
+                if not textContent.isascii():
+                  textContent = unicodedata.normalize("NFC", textContent)
               else:
                 textContent = line.text
                 if ( textContent == None):
@@ -448,28 +497,62 @@ class HocrConverter():
                   textContent = u""
                 textContent = textContent.rstrip()
               
-              # scale the width of the text to fill the width of the line's bbox
-              if len(textContent) != 0:
-                text.setHorizScale( ((( float(coords[2])/ocr_dpi[0]*inch ) - ( float(coords[0])/ocr_dpi[0]*inch )) / pdf.stringWidth( textContent, fontname, fontsize))*100)
+              # nothing to put on the page
+              if not textContent and not withVisibleBoundingBoxes:
+                continue
+              
+              parse_result = self.parse_element_title( line )
+              coords = parse_result.get( "bbox", (0,0,0,0) )
+              
+              text_corner1x = coords[0]*sx
+              text_corner1y = coords[1]*sy
+
+              text_corner2x = coords[2]*sx
+              text_corner2y = coords[3]*sy
+              
+              text_width = (coords[2]-coords[0])*sx
+              text_height = (coords[3]-coords[1])*sy
+              
+              if verticalInversion:
+                text_corner2y_inv = page_h_pts - text_corner1y
+                text_corner1y_inv = page_h_pts - text_corner2y
+                
+                text_corner1y = text_corner1y_inv
+                text_corner2y = text_corner2y_inv
+
+              if textContent:
+                # set cursor to bottom left corner of line bbox (adjust for dpi)
+                text.setTextOrigin( text_corner1x, text_corner1y )
 
-              if not withVisibleOCRText:
-                text.setTextRenderMode(3) # invisible
+                # scale the width of the text to fill the width of the line's bbox
+                text.setHorizScale( ( text_width / _strwidth( textContent, fontname, fontsize ) )*100 )
              
-              # Text color
-              text.setFillColorRGB(textColor[0],textColor[1],textColor[2])
+                # Text color, only emitted when it changes
+                if textColor != last_fill:
+                  text.setFillColorRGB(textColor[0],textColor[1],textColor[2])
+                  last_fill = textColor
 
-              # write the text to the page
-              text.textLine( textContent )
+                # write the text to the page
+                text.textLine( textContent )
 
-              vprint( VVERBOSE, "processing", text_class, coords,"->", text_corner1x, text_corner1y, text_corner2x, text_corner2y, ":", textContent )
-              pdf.drawText(text)
+              if logging.root.isEnabledFor( VVERBOSE ):
+                logging.log( VVERBOSE, "processing %s %s -> %s %s %s %s : %s", text_class, coords, text_corner1x, text_corner1y, text_corner2x, text_corner2y, textContent )
 
-              pdf.setLineWidth(0.1)
-              pdf.setStrokeColorRGB(bboxColor[0],bboxColor[1],bboxColor[2])
-       
-              # Draw a box around the text object
+              # Collect a box around the text object
               if withVisibleBoundingBoxes: 
-                pdf.rect( text_corner1x, text_corner1y, text_width, text_height);
+                if bboxColor not in bbox_paths:
+                  bbox_paths[bboxColor] = pdf.beginPath()
+                bbox_paths[bboxColor].rect( text_corner1x, text_corner1y, text_width, text_height )
+
+          # put the collected text on the page
+          pdf.drawText(text)
+
+          # Draw the boxes
+          if bbox_paths:
+            pdf.setLineWidth(0.1)
+          for bboxColor, bbox_path in bbox_paths.items():
+            pdf.setStrokeColorRGB(bboxColor[0],bboxColor[1],bboxColor[2])
+            pdf.drawPath( bbox_path, stroke=1, fill=0 )
      
         # finish up the page. A blank new one is initialized as well.
         pdf.showPage()
@@ -527,6 +610,12 @@ def vprint( verbosity, *data, **keywords ):
 
   global _vprint_text
 
+  # Nothing to format if the message would be dropped anyway
+  if not logging.root.isEnabledFor( verbosity ):
+    if not nolinebreak:
+      _vprint_text = ""
+    return
+
   out_text = _vprint_text
   for out in data:
     if out_text != "":
@@ -535,8 +624,7 @@ def vprint( verbosity, *data, **keywords ):
 
   # If nolinebreak is enabled, save message for next output
   if nolinebreak:
-    if logging.root.isEnabledFor( verbosity ):
-      _vprint_text = out_text
+    _vprint_text = out_text
   else:
     _vprint_text = ""
     logging.log( verbosity, out_text )
@@ -67,9 +67,9 @@ from ocrmypdf.pluginspec import OcrEngine
 import io
 import os
 import sys
+import tempfile
 from google.cloud import vision
 from google.cloud.vision_v1 import AnnotateImageResponse
-import json
 
 file_dir = os.path.dirname(__file__)
 sys.path.append(file_dir)
@@ -117,6 +117,10 @@ def filter_page_image(page, image_filename):
 
 class GVisionOcrEngine(OcrEngine):
 
+    # client is reused for all pages, see _get_client
+    _client = None
+    _client_keypath = None
+
     @staticmethod
     def creator_tag(options):
         return "Google Vision as OCR"
@@ -128,30 +132,39 @@ class GVisionOcrEngine(OcrEngine):
     def __str__(self):
         return "Try to use Google Vision Engine in MyOCRPDF"
 
+    @classmethod
+    def _get_client(cls, keypath):
+        #creating a client loads the credentials and opens the grpc channel,
+        #so only do it once per key
+        if cls._client is None or cls._client_keypath != keypath:
+            cls._client = vision.ImageAnnotatorClient.from_service_account_json(keypath)
+            cls._client_keypath = keypath
+        return cls._client
+
     @staticmethod
     def generate_hocr(input_file, output_hocr, output_text, options):
         #print('HOCRHOCRCHOCOAODSOASDOOS')
         #initialize client
-        client = vision.ImageAnnotatorClient.from_service_account_json(os.path.normpath(file_dir+'/'+options.apikey))
+        client = GVisionOcrEngine._get_client(os.path.normpath(file_dir+'/'+options.apikey))
 
         #load file
         with io.open(input_file, 'rb') as image_file:
             content = image_file.read()
 
         image = vision.Image(content=content)
+        #one request per page: ocrmypdf calls the engine for each page on its
+        #own and needs the result before the call returns, so pages can't be
+        #collected into a batch_annotate_images call here. Latency is hidden
+        #by ocrmypdf running several pages in parallel (--jobs) instead
         response = client.document_text_detection(image=image, image_context={"language_hints": ["de"]})
 
-        #get json response
-        #https://newbedev.com/convert-google-vision-api-response-to-json
-        json_response = AnnotateImageResponse.to_json(response)
+        #convert the response to the dict layout of the json api, without
+        #the detour over json text. Same options as to_json: camelCase keys
+        #(gcv2hocr2 reads those) and integer enums
+        resp_dict = AnnotateImageResponse.to_dict(response, preserving_proto_field_name=False, use_integers_for_enums=True)
 
         #modify response to feed it to gcv2hocr2
-        resp_for_gcv = {"responses": [json.loads(json_response)]}
-
-        '''with (open('json_response', 'w', encoding="utf-8")) as outfile:
-            outfile.write(json_response)
-            outfile.close()
-        '''
+        resp_for_gcv = {"responses": [resp_dict]}
         page = gcv2hocr2.fromResponse(resp_for_gcv, 'pagename')
 
         #output hocr
@@ -166,24 +179,23 @@ class GVisionOcrEngine(OcrEngine):
     @staticmethod
     def generate_pdf(input_file, output_pdf, output_text, options):
         #print(output_pdf)
-        hocr_tempfile = 'tempfile'
-        GVisionOcrEngine.generate_hocr(input_file, hocr_tempfile, output_text, options)
-        helper = hocrtransform.HocrTransform(
-            hocr_filename = hocr_tempfile,
-            dpi=300
-        )
-
-        helper.to_pdf(out_filename=output_pdf)
-        helper.to_pdf(out_filename='output1.pdf',show_bounding_boxes=True)
-        #helper.to_pdf(out_filename='output11.pdf', invisible_text=False, fontname='DarkGardenMK')
-        #helper.to_pdf(out_filename='output111_pdf.pdf',image_filename=input_file, invisible_text=False, fontname='CALLIG15')
-        #helper.to_pdf(out_filename='output11_pdf.pdf', image_filename=input_file, invisible_text=False,show_bounding_boxes=True)
-        #helper.to_pdf(out_filename='output1_pdf.pdf', invisible_text=True,fontname='CALLIG15')
-        #helper.to_pdf(out_filename=output_pdf, invisible_text=True, fontname='CALLIG15')
-        #print('PDF END END END END END------------------')
-        #import shutil
-        #shutil.copy('hocr.pdf' , output_pdf)
-        #print(output_pdf.name)
+        #unique name, ocrmypdf processes pages in parallel
+        with tempfile.NamedTemporaryFile(mode='w', suffix='.hocr', delete=False) as tf:
+            hocr_tempfile = tf.name
+        try:
+            GVisionOcrEngine.generate_hocr(input_file, hocr_tempfile, output_text, options)
+            helper = hocrtransform.HocrTransform(
+                hocr_filename = hocr_tempfile,
+                dpi=300
+            )
+
+            helper.to_pdf(out_filename=output_pdf)
+
+            #debug output with bounding boxes, reuses the parsed hocr
+            if os.environ.get('GVISION_DEBUG_BBOX'):
+                helper.to_pdf(out_filename=str(output_pdf) + '.bbox.pdf', show_bounding_boxes=True)
+        finally:
+            os.unlink(hocr_tempfile)
 
     @staticmethod
     def languages(options):